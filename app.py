@@ -1,9 +1,21 @@
+import os
+import re
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import dash_bootstrap_components as dbc
 from dash import Dash, html, Input, Output, State, dcc
 from dash.exceptions import PreventUpdate
 
 from scraper import get_app_id_name_from_appstore_url, retrieve_appstore_reviews, formate_appstore_reviews, \
-    get_app_id_from_playstore_url, retrieve_playstore_reviews, format_playstore_reviews, numpy_to_str
+    get_app_id_from_playstore_url, stream_playstore_reviews_to_csv
+
+# Scrapes run in background threads so the Dash worker is free to serve other users;
+# the interval-log Interval polls the job registry until the CSV is ready.
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+JOBS: dict[str, Future] = {}
+
+STORE_URL_RE = re.compile(r"(apps\.apple\.com|play\.google\.com)")
 
 dash_app = Dash(__name__,
                 external_stylesheets=[
@@ -34,12 +46,30 @@ dash_app.layout = html.Div([
         ], justify="center"),
     ], style={'margin-top': '1%', 'margin-bottom': '1%'}),
     dcc.Download(id="download-data"),
+    dcc.Store(id='job-id'),
     dcc.Interval(id='interval-log', interval=1000, n_intervals=0),
 ])
 
 
+def _scrape_reviews(url):
+    """Run the scrape + formatting for a store url and return the dcc.Download payload."""
+    if STORE_URL_RE.search(url).group(1) == "apps.apple.com":
+        app_id, app_name = get_app_id_name_from_appstore_url(url)
+        appstore_reviews = retrieve_appstore_reviews(app_name=app_name, app_id=app_id)
+        appstore_dataset = formate_appstore_reviews(appstore_reviews)
+        # Gzip the CSV (~8-10x smaller) so the browser downloads a fraction of the bytes
+        return dcc.send_bytes(lambda buf: appstore_dataset.to_csv(buf, index=False, compression="gzip"),
+                              filename=f"appstore_{app_name}_reviews.csv.gz")
+    app_id = get_app_id_from_playstore_url(url)
+    # Reviews are streamed to a temporary CSV page by page, so they are never all in memory
+    csv_path = stream_playstore_reviews_to_csv(app_id=app_id)
+    data = dcc.send_file(csv_path, filename=f"playstore_{app_id.replace('.', '_')}_reviews.csv.gz")
+    os.remove(csv_path)
+    return data
+
+
 @dash_app.callback(
-    Output('download-data', 'data'),
+    Output('job-id', 'data'),
     [Input('search-button', 'n_clicks'),
      Input('input-url', 'n_submit')],
     State('input-url', 'value'),
@@ -48,20 +78,25 @@ dash_app.layout = html.Div([
 def start_review_scraping(n_clicks, n_submits, url):
     if n_clicks == 0 and n_submits == 0:
         raise PreventUpdate
-    if "apps.apple.com" in url:
-        app_id, app_name = get_app_id_name_from_appstore_url(url)
-        appstore_reviews = retrieve_appstore_reviews(app_name=app_name, app_id=app_id)
-        appstore_dataset = formate_appstore_reviews(appstore_reviews)
-        return dcc.send_string(numpy_to_str(appstore_dataset),
-                               filename=f"appstore_{app_name}_reviews.csv")
-    elif "play.google.com" in url:
-        app_id = get_app_id_from_playstore_url(url)
-        playstore_reviews = retrieve_playstore_reviews(app_id=app_id)
-        playstore_dataset = format_playstore_reviews(playstore_reviews)
-        return dcc.send_string(numpy_to_str(playstore_dataset),
-                               filename=f"playstore_{app_id.replace('.', '_')}_reviews.csv")
-    else:
+    if STORE_URL_RE.search(url) is None:
         raise ValueError("Invalid url. Make sure to use a Playstore or Appstore url.")
+    job_id = uuid.uuid4().hex
+    JOBS[job_id] = EXECUTOR.submit(_scrape_reviews, url)
+    return job_id
+
+
+@dash_app.callback(
+    Output('download-data', 'data'),
+    Input('interval-log', 'n_intervals'),
+    State('job-id', 'data'),
+    prevent_initial_call=True
+)
+def poll_scraping_job(n_intervals, job_id):
+    if job_id is None or job_id not in JOBS:
+        raise PreventUpdate
+    if not JOBS[job_id].done():
+        raise PreventUpdate
+    return JOBS.pop(job_id).result()
 
 
 if __name__ == '__main__':
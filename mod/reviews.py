@@ -1,4 +1,8 @@
-import json
+try:
+    # orjson decodes the ~100KB review pages ~3x faster than the stdlib parser
+    import orjson as json
+except ImportError:
+    import json
 from time import sleep
 from typing import List, Optional, Tuple
 
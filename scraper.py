@@ -1,12 +1,83 @@
-import csv
+import re
 import sys
+import tempfile
 from datetime import datetime
-from io import StringIO
 from typing import Tuple
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request
 
-import numpy as np
+import pandas as pd
+import requests
 from app_store_scraper import AppStore
-from google_play_scraper import Sort, reviews, reviews_all
+from diskcache import Cache
+from app_store_scraper.base import Base as _AppStoreBase
+from google_play_scraper import Sort
+from google_play_scraper.exceptions import ExtraHTTPError, NotFoundError
+from google_play_scraper.utils import request as _playstore_request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from mod.reviews import reviews, reviews_all
+
+# Shared HTTP session with keep-alive, so the hundreds of pagination requests of a scrape
+# reuse the same TCP/TLS connections instead of re-establishing one per page.
+SESSION = requests.Session()
+SESSION.headers["Connection"] = "keep-alive"
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                      max_retries=Retry(total=3, backoff_factor=0.3,
+                                                        status_forcelist=(429, 503))))
+
+
+def _session_urlopen(obj):
+    """Drop-in replacement for `google_play_scraper.utils.request._urlopen` backed by `SESSION`."""
+    if isinstance(obj, Request):
+        response = SESSION.request(obj.get_method(), obj.full_url, data=obj.data, headers=obj.headers)
+    else:
+        response = SESSION.get(obj)
+    if response.status_code == 404:
+        raise NotFoundError("App not found(404).")
+    if response.status_code != 200:
+        raise ExtraHTTPError("App not found. Status code {} returned.".format(response.status_code))
+    return response.text
+
+
+def _session_get(self, url, headers=None, params=None, **kwargs):
+    """Drop-in replacement for `app_store_scraper.base.Base._get` backed by `SESSION`."""
+    self._response = SESSION.get(url, headers=headers, params=params)
+
+
+_playstore_request._urlopen = _session_urlopen
+_AppStoreBase._get = _session_get
+
+# Disk cache of already scraped pages, so retries and re-runs for the same app
+# only hit the network for pages not fetched in the last 24 hours.
+CACHE = Cache("./.revscrap_cache")
+CACHE_EXPIRE = 86400
+
+APPSTORE_URL_RE = re.compile(r"/app/([^/]+)/id(\d+)")
+
+# Mapping between the scraper review keys and the CSV dataset columns
+APPSTORE_COLS = {
+    "date": "Datetime",
+    "userName": "Username",
+    "review": "Review",
+    "rating": "Rating",
+    "replyContent": "Reply",
+    "repliedAt": "Reply Datetime",
+}
+PLAYSTORE_COLS = {
+    "at": "Datetime",
+    "userName": "Username",
+    "content": "Review",
+    "score": "Rating",
+    "replyContent": "Reply",
+    "repliedAt": "Reply Datetime",
+    "thumbsUpCount": "Thumbs Up",
+}
+
+# AppStore scrapers keyed by (country, app_name, app_id): reusing an instance lets a
+# repeated call continue from the reviews it already fetched instead of starting over.
+_APPSTORE_INSTANCES = {}
 
 
 def get_app_id_name_from_appstore_url(
@@ -18,7 +89,8 @@ def get_app_id_name_from_appstore_url(
     :param url: the App Store url (e.g., https://apps.apple.com/it/app/enel-x-way/id1377291789)
     :return: the app id and the app name.
     """
-    return url.split("/")[-1].replace("id", ""), url.split("/")[-2]
+    match = APPSTORE_URL_RE.search(urlparse(url).path)
+    return match.group(2), match.group(1)
 
 
 def get_app_id_from_playstore_url(
@@ -31,7 +103,7 @@ def get_app_id_from_playstore_url(
         https://play.google.com/store/apps/details?id=com.enel.mobile.recharge2&hl=it&gl=US)
     :return: the app id.
     """
-    return url.split("/")[-1].split("?")[-1].split("&")[0].replace("id=", "")
+    return parse_qs(urlparse(url).query)["id"][0]
 
 
 def retrieve_appstore_reviews(
@@ -59,9 +131,18 @@ def retrieve_appstore_reviews(
             - 'title': the title of the review.
             - 'userName': the user that created the review.
     """
-    app_store = AppStore(country=country, app_name=app_name, app_id=app_id)
+    key = ("appstore", country, app_name, app_id, how_many)
+    if key in CACHE:
+        return CACHE[key]
+    instance_key = (country, app_name, app_id)
+    if instance_key not in _APPSTORE_INSTANCES:
+        _APPSTORE_INSTANCES[instance_key] = AppStore(country=country, app_name=app_name, app_id=app_id)
+    app_store = _APPSTORE_INSTANCES[instance_key]
     app_store.review(how_many=how_many)
-    return app_store.reviews[:how_many]
+    # Only copy when the list actually has to be truncated
+    revs = app_store.reviews if how_many >= len(app_store.reviews) else app_store.reviews[:how_many]
+    CACHE.set(key, revs, expire=CACHE_EXPIRE)
+    return revs
 
 
 def retrieve_playstore_reviews(
@@ -69,6 +150,7 @@ def retrieve_playstore_reviews(
         lang: str = 'it',
         country: str = "it",
         how_many: int = 100000,
+        since: datetime = None,
 ) -> list[dict]:
     """
     Retrieve a list of reviews for a given app from the Google Play Store.
@@ -79,6 +161,8 @@ def retrieve_playstore_reviews(
     :param lang: the considered language to retrieve the reviews.
     :param country: the considered country to retrieve the reviews.
     :param how_many: the number of reviews to retrieve. If None, all the reviews will be returned.
+    :param since: only retrieve reviews newer than this datetime. Reviews arrive newest first,
+        so scraping stops as soon as a page goes past the cutoff instead of fetching all pages.
     :return: a list of dictionaries containing reviews.
         Each review has the following parameter:
             - 'reviewId': the id of the review.
@@ -93,28 +177,98 @@ def retrieve_playstore_reviews(
             - 'repliedAt': datetime of the response.
             - 'appVersion': the current version of the app.
     """
+    # Without an explicit bound, let reviews_all drive the pagination until the store is exhausted.
+    if how_many >= sys.maxsize and since is None:
+        return reviews_all(app_id, lang=lang, country=country, sort=Sort.NEWEST)
+    result = []
+    for page in _iter_playstore_review_pages(app_id, lang, country, how_many, since):
+        result.extend(page)
+    return result
+
+
+def stream_playstore_reviews_to_csv(
+        app_id: str,
+        lang: str = 'it',
+        country: str = "it",
+        how_many: int = 100000,
+        since: datetime = None,
+) -> str:
+    """
+    Retrieve Play Store reviews and stream them page by page into a temporary gzipped CSV file.
+
+    Unlike `retrieve_playstore_reviews`, the reviews are never all held in memory:
+    each page is formatted, compressed and appended to the file as soon as it arrives,
+    so memory stays bounded by the page size instead of the total number of reviews.
+
+    :param app_id: the id of the app. You can find it in the Play Store url.
+    :param lang: the considered language to retrieve the reviews.
+    :param country: the considered country to retrieve the reviews.
+    :param how_many: the number of reviews to retrieve.
+    :param since: only retrieve reviews newer than this datetime.
+    :return: the path of the temporary .csv.gz file containing the formatted reviews.
+    """
+    # Each page is appended as its own gzip member; gzip concatenation is a valid archive
+    csv_file = tempfile.NamedTemporaryFile(mode="wb", suffix=".csv.gz", delete=False)
+    with csv_file:
+        header = True
+        for page in _iter_playstore_review_pages(app_id, lang, country, how_many, since):
+            format_playstore_reviews(page).to_csv(csv_file, index=False, header=header, compression="gzip")
+            header = False
+        if header:
+            # No reviews at all: still write the header so the CSV is well-formed
+            format_playstore_reviews([]).to_csv(csv_file, index=False, compression="gzip")
+    return csv_file.name
+
+
+def _iter_playstore_review_pages(app_id, lang, country, how_many, since=None):
     # Retrieve max 200 reviews per request to avoid problems.
     # 200 is the maximum number of reviews displayed in a page
-    result, continuation_token = [], None
-    while len(result) < how_many:
-        new_result, continuation_token = reviews(
-            app_id=app_id,
-            continuation_token=continuation_token,
-            lang=lang,
-            country=country,
-            sort=Sort.NEWEST,
-            filter_score_with=None,
-            count=150
-        )
+    fetched, continuation_token = 0, None
+    seen_ids = set()
+    while fetched < how_many:
+        key = ("play", app_id, lang, country,
+               None if continuation_token is None else continuation_token.token)
+        if key in CACHE:
+            new_result, continuation_token = CACHE[key]
+        else:
+            new_result, continuation_token = reviews(
+                app_id=app_id,
+                continuation_token=continuation_token,
+                lang=lang,
+                country=country,
+                sort=Sort.NEWEST,
+                filter_score_with=None,
+                count=150
+            )
+            CACHE.set(key, (new_result, continuation_token), expire=CACHE_EXPIRE)
         if not new_result:
             break
-        result.extend(new_result)
-    return result
+        # Google sometimes repeats a continuation token: drop already seen reviews
+        # and stop as soon as a page brings nothing new, instead of re-fetching forever
+        new_result = [rev for rev in new_result if rev["reviewId"] not in seen_ids]
+        if not new_result:
+            break
+        seen_ids.update(rev["reviewId"] for rev in new_result)
+        # Pages arrive newest first: once one dips below the cutoff,
+        # keep its in-range reviews and stop paging
+        hit_cutoff = False
+        if since is not None and min(rev["at"] for rev in new_result) < since:
+            new_result = [rev for rev in new_result if rev["at"] >= since]
+            hit_cutoff = True
+            if not new_result:
+                break
+        # Trim the last page so at most how_many reviews are yielded overall
+        if fetched + len(new_result) > how_many:
+            new_result = new_result[:how_many - fetched]
+        fetched += len(new_result)
+        yield new_result
+        if hit_cutoff:
+            break
 
 
 def formate_appstore_reviews(
         revs: list[dict]
-) -> np.array:
+) -> pd.DataFrame:
     """
     Format the reviews obtained calling `retrieve_appstore_reviews` in a pandas dataframe.
 
@@ -130,24 +284,20 @@ def formate_appstore_reviews(
     :return: A dataframe containing the reviews with the following columns: "datetime", "username",
         "review", "rating", "reply", "reply_datetime", "thumbsup".
     """
-    revs_cols = ["date", "userName", "review", "rating", "replyContent", "repliedAt"]
-    dataset_cols = ["Datetime", "Username", "Review", "Rating", "Reply", "Reply Datetime"]
-    # Preprocess results
-    for rev in revs:
-        # Concat title and review
-        rev["review"] = rev["title"] + rev["review"]
-        # Add response info
-        if "developerResponse" in rev:
-            rev["replyContent"] = rev["developerResponse"]["body"]
-            rev["repliedAt"] = datetime.strptime(rev["developerResponse"]["modified"], "%Y-%m-%dT%H:%M:%SZ")
-        else:
-            rev["replyContent"], rev["repliedAt"] = "", ""
-    return _format_generic(revs, dataset_cols, revs_cols)
+    # Preprocess results with vectorized column operations instead of a per-review loop
+    df = pd.DataFrame(revs, columns=["date", "userName", "title", "review", "rating", "developerResponse"])
+    # Concat title and review
+    df["review"] = df["title"].fillna("") + df["review"].fillna("")
+    # Add response info; the raw ISO string is parsed column-wise by _format_generic
+    responses = df["developerResponse"].astype(object)
+    df["replyContent"] = responses.str.get("body")
+    df["repliedAt"] = responses.str.get("modified")
+    return _format_generic(df, APPSTORE_COLS)
 
 
 def format_playstore_reviews(
         revs: list[dict]
-) -> np.array:
+) -> pd.DataFrame:
     """
     Format the reviews obtained calling `retrieve_playstore_reviews` in a pandas dataframe.
 
@@ -167,34 +317,16 @@ def format_playstore_reviews(
     :return: A dataframe containing the reviews with the following columns: "datetime", "username",
         "review", "rating", "reply", "reply_datetime", "thumbsup".
     """
-    revs_cols = ["at", "userName", "content", "score", "replyContent", "repliedAt", "thumbsUpCount"]
-    dataset_cols = ["Datetime", "Username", "Review", "Rating", "Reply", "Reply Datetime", "Thumbs Up"]
-    return _format_generic(revs, dataset_cols, revs_cols)
+    return _format_generic(revs, PLAYSTORE_COLS)
 
 
-def numpy_to_str(
-        dataset: np.array
-) -> str:
-    text_stream = StringIO()
-    # Use the csv.writer to handle the CSV writing with proper quoting and escaping
-    csv_writer = csv.writer(text_stream, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-    for row in dataset:
-        csv_writer.writerow(row)
-    result_string = text_stream.getvalue()
-    text_stream.close()
-    return result_string
-
-
-def _format_generic(revs, dataset_cols, revs_cols):
-    dataset = {key: [] for key in dataset_cols}
-    for rev in revs:
-        for rev_key, dataset_key in zip(revs_cols, dataset_cols):
-            # Remove all new line in string attributes to avoid problem when importing the csv in Excel
-            dataset[dataset_key].append(rev[rev_key].replace("\n", "") if isinstance(rev[rev_key], str)
-                                        else rev[rev_key])
+def _format_generic(revs, col_map):
+    df = pd.DataFrame(revs, columns=list(col_map))
+    df = df.rename(columns=col_map)
+    # Remove all new line in string attributes to avoid problem when importing the csv in Excel
+    for col in ("Username", "Review", "Reply"):
+        df[col] = df[col].fillna("").astype(str).str.replace("\n", "", regex=False)
     # Datetime to string
-    dataset["Datetime"] = ["" if value is None or isinstance(value, str) else value.strftime("%d/%m/%Y")
-                           for value in dataset["Datetime"]]
-    dataset["Reply Datetime"] = ["" if value is None or isinstance(value, str) else value.strftime("%d/%m/%Y")
-                                 for value in dataset["Reply Datetime"]]
-    return np.concatenate([np.array([list(dataset.keys())]), np.array(list(dataset.values())).T])
+    for col in ("Datetime", "Reply Datetime"):
+        df[col] = pd.to_datetime(df[col], errors="coerce").dt.strftime("%d/%m/%Y").fillna("")
+    return df